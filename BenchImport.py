@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# BenchImport
+#
+# Startup benchmark: cold-import time of the libraries, each measured in a fresh
+# interpreter (so nothing is already in sys.modules), and the heavy modules each
+# import pulls in. MutLib, PlotSpec and ClustPlot should load none of them; the
+# plotting and clustering stacks are imported on first use.
+#
+# Usage: python BenchImport.py [-n REPEATS] [-o bench_output.txt]
+
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+heavy_modules = ('matplotlib', 'matplotlib.pyplot', 'Bio', 'seaborn', 'pandas', 'scipy',
+                 'fastcluster', 'sklearn', 'statistics')
+
+# What is imported, and what is run after it (ie. the first use of a plot).
+benchmarks = [('MutLib', 'import MutLib', ''),
+              ('PlotSpec', 'import PlotSpec', ''),
+              ('ClustPlot', 'import ClustPlot', ''),
+              ('PlotSpec + first figure', 'import PlotSpec',
+               'PlotSpec.SpecTemplate(xlabels=[[c for _, c in PlotSpec.spec_channels()]], '
+               'labels=PlotSpec.py_muts)')]
+
+_probe = """
+import sys, time, json
+start = time.perf_counter()
+{imports}
+imported = time.perf_counter() - start
+{use}
+used = time.perf_counter() - start
+print(json.dumps({{'import': imported, 'total': used,
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def cold_import(imports, use='', repeats=5):
+    # Run the probe in repeats fresh interpreters, from the directory of this script.
+    # Returns the best import and total (import + use) times, and the heavy modules loaded.
+
+    code = _probe.format(imports=imports, use=use, heavy=heavy_modules)
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code], cwd=here, check=True,
+                             capture_output=True, text=True).stdout
+        runs.append(json.loads(out.splitlines()[-1]))
+    return (min(run['import'] for run in runs), min(run['total'] for run in runs),
+            runs[-1]['heavy'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-import time of MutLib, PlotSpec and ClustPlot.')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='fresh interpreters per benchmark (best is kept)')
+    parser.add_argument('-o', '--output', default=None, help='also write the report to this file')
+    args = parser.parse_args()
+
+    lines = ['{:<26}{:>12}{:>12}  {}'.format('benchmark', 'import (s)', 'total (s)', 'heavy modules loaded')]
+    for name, imports, use in benchmarks:
+        imported, total, heavy = cold_import(imports, use, args.repeats)
+        lines.append('{:<26}{:>12.3f}{:>12.3f}  {}'.format(name, imported, total, ', '.join(heavy) or '-'))
+        print(lines[-1] if len(lines) > 2 else '\n'.join(lines), flush=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -11,17 +11,28 @@
 
 
 from collections import OrderedDict
-from scipy.cluster.hierarchy import dendrogram
-from fastcluster import linkage
-from sklearn.metrics.pairwise import cosine_similarity
 
 import numpy as np
-import pandas as pd
-import seaborn as sns
-import matplotlib as mpl
-mpl.use('agg')
-import matplotlib.pyplot as plt
 
+# scipy, fastcluster, sklearn, pandas, seaborn and matplotlib are imported by the
+# functions that use them, on first use, so importing ClustPlot stays cheap.
+
+_agg_selected = False
+
+def _pyplot():
+    # matplotlib.pyplot, with the agg backend selected the first time
+    global _agg_selected
+    import matplotlib as mpl
+    if not _agg_selected:
+        mpl.use('agg')
+        _agg_selected = True
+    import matplotlib.pyplot as plt
+    return plt
+
+def cosine_similarity(X, Y=None):
+    # Cosine similarities between the rows of X (and Y), from sklearn
+    from sklearn.metrics.pairwise import cosine_similarity as sk_cosine_similarity
+    return sk_cosine_similarity(X, Y)
 
 
 def refine(mut_sig):
@@ -98,6 +109,7 @@ def uhc_cluster(spec_list, ref_sig=None):
     # Unsupervised hierarchical clusters (uhc) from a collection of spectra.
     # Spec_list is a dictionary;
     # Uses linkage from fastcluster
+    from fastcluster import linkage
 
     if ref_sig is not None:
         spectra = [list(ref_sig.values())] # so ref signature is value 0
@@ -107,6 +119,14 @@ def uhc_cluster(spec_list, ref_sig=None):
         spectra.append(list(spec_list[sig].values()))
     return linkage(spectra, method='ward', metric='cosine')
 
+def _output_list(file_name, fmt):
+    # File names and formats as lists of the same length
+    if isinstance(file_name, str):
+        return [file_name], [fmt]
+    if fmt is None or isinstance(fmt, str):
+        fmt = [fmt] * len(file_name)
+    return list(file_name), list(fmt)
+
 def plot_uhc_heatmap(spec_list, cluster_names, isText, file_name, fmt, st_col):
 
     # Plot a clustermap with dendrogram and histogram heatmap.
@@ -114,9 +134,13 @@ def plot_uhc_heatmap(spec_list, cluster_names, isText, file_name, fmt, st_col):
     # spec_list: a dictionary of spectra to be compared/plotted
     # cluster_names: the names of the spectra above; used for labeling plot rows/cols.
     # isText: a flag to display cossim values (True), or no display (False)
-    # file_name: name of the figure file to be saved (with extension)
-    # fmt: format of figure file (e.g. svg, pdf, eps)
+    # file_name: name of the figure file to be saved (with extension), or a list of names
+    # fmt: format of figure file (e.g. svg, pdf, eps), or a list with one format per file name
+    # The similarities and linkage are computed and the clustermap drawn once for all the files.
+    import pandas as pd
+    import seaborn as sns
 
+    plt = _pyplot()
     spectra = []
     for sig in list(spec_list.keys()):
         spectra.append(list(spec_list[sig].values()))
@@ -140,31 +164,35 @@ def plot_uhc_heatmap(spec_list, cluster_names, isText, file_name, fmt, st_col):
 
   #  plt.show()  # change backend for this to work; use TkAgg instead of agg, for example.
 
-    plt.savefig(file_name, format=fmt, dpi=450, bbox_inches='tight')
+    file_names, fmts = _output_list(file_name, fmt)
+    for name, form in zip(file_names, fmts):
+        grid.fig.savefig(name, format=form, dpi=450, bbox_inches='tight')
 
-    plt.close(plt.gcf())  # important to close the figure once it's done...
+    plt.close(grid.fig)  # important to close the figure once it's done...
 
 def plot_uhc_dendrogram(spec_list, cluster_names, file_name, fmt):
 
     # As above but just the dendrogram.
+    # file_name and fmt can also be lists, to save the same dendrogram in several formats.
+    from scipy.cluster.hierarchy import dendrogram
 
+    plt = _pyplot()
     spectra = []
     for sig in spec_list:
         spectra.append(list(spec_list[sig].values()))
-    data = spectra
     labels = cluster_names
     linkages = uhc_cluster(spec_list)
     with plt.rc_context({'lines.linewidth':0.5}):
-        dendrogram(linkage(pd.DataFrame(data, [labels, ['']*len(labels)]),
-                                 method='ward',
-                                 metric='cosine'),
+        dendrogram(linkages,
                          no_labels=False,
                          labels=labels,
                          leaf_rotation=90,
                          leaf_font_size=4,
                          link_color_func=lambda x:'k')
   #  plt.show()
-    plt.savefig(file_name, format=fmt, dpi=450)
+    file_names, fmts = _output_list(file_name, fmt)
+    for name, form in zip(file_names, fmts):
+        plt.savefig(name, format=form, dpi=450)
   
     plt.close(plt.gcf()) # important to close the figure once it's done...
 
@@ -15,11 +15,22 @@
 
 
 import os
+import gzip
+import json
+import time
+import pickle
+import hashlib
+import logging
 import argparse
+import tempfile
 
-from Bio import SeqIO
+import numpy as np
+
+from bisect import bisect_right
 from collections import OrderedDict
-from itertools import cycle, product
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from itertools import cycle, islice, product
 
 ##Global vars
 purines, pyrimidines = ('A', 'G'), ('C', 'T')
@@ -29,109 +40,899 @@ py_muts = ('C>A', 'C>G', 'C>T', 'T>A', 'T>C', 'T>G')
 pu_muts = ('G>T', 'G>C', 'G>A', 'A>T', 'A>G', 'A>C')
 
 all_muts = py_muts+pu_muts
+comp_muts = dict(zip(py_muts+pu_muts, pu_muts+py_muts))
+
+
+# Integer code of each base (index in dna_bases) and of its complement.
+# Anything that is not A, C, G or T is coded 4.
+base_codes = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(dna_bases):
+    base_codes[ord(_b)] = base_codes[ord(_b.lower())] = _i
+comp_codes = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+
+# Read count columns of Loeb .mutpos files, and their order in dna_bases
+loeb_bases = 'TCGA'
+loeb_order = [loeb_bases.index(b) for b in dna_bases]
 
 
 ##Alexandrov/Stratton color scheme
 sig_colors = ['#52C3F1', '#231F20', '#E62223', '#CBC9C8', '#97D54C', '#EDBFC2']
 
 
+# Process-wide cache of parsed FASTA files, see fasta_to_dict
+_ref_cache = OrderedDict()
+_ref_cache_config = {'max_bytes': 4 * 1024 ** 3, 'disk_dir': None}
+
+
+def set_reference_cache(max_bytes=None, disk_dir=None):
+    """
+    Configure the reference cache used by fasta_to_dict.
+
+    Parameters
+    ----------
+    max_bytes : int or None
+        Memory budget (total sequence length) of the in-process cache. Least
+        recently used references are evicted beyond it; 0 disables caching.
+    disk_dir : str or None
+        If given, parsed references are also pickled there and reloaded from
+        there by later sessions. Use '' to turn the disk cache off.
+    """
+    if max_bytes is not None:
+        _ref_cache_config['max_bytes'] = max_bytes
+    if disk_dir is not None:
+        _ref_cache_config['disk_dir'] = disk_dir or None
+    _evict_references()
+
+
+# Directory for files derived from inputs (packed references, position indexes,
+# kmer counts), see set_store_dir
+_store_config = {'store_dir': None,
+                 'fallback_dir': os.path.join(os.path.expanduser('~'), '.cache', 'MutLib')}
+
+
+def set_store_dir(store_dir=None):
+    """
+    Set the directory where files derived from inputs are written: packed
+    references (.rpk, see open_reference), position indexes of bgzip files
+    (.mpi, see index_mut_file) and kmer counts (see count_kmers).
+
+    By default (store_dir None) they are written next to their input, or in
+    ~/.cache/MutLib when the directory of the input is not writable. Derived
+    files that already exist next to a read-only input are still used.
+    """
+    _store_config['store_dir'] = store_dir
+
+
+def _derived_file(input_file, ext):
+    # Path of the file derived from input_file with extension ext: input_file + ext,
+    # or a name unique to the input path in the store directory (see set_store_dir)
+    store_dir = _store_config['store_dir']
+    if store_dir is None:
+        if os.access(os.path.dirname(os.path.abspath(input_file)), os.W_OK):
+            return input_file + ext
+        store_dir = _store_config['fallback_dir']
+    digest = hashlib.sha1(os.path.abspath(input_file).encode()).hexdigest()[:16]
+    return os.path.join(store_dir, '{}-{}{}'.format(digest, os.path.basename(input_file), ext))
+
+
+def _derived_candidates(input_file, ext):
+    # Where a derived file may already be: the write location first, then next to the input
+    return list(OrderedDict.fromkeys([_derived_file(input_file, ext), input_file + ext]))
+
+
+_file_mode = []
+
+@contextmanager
+def _atomic_file(path, mode='wb'):
+    # Write path through a unique temporary file in the same directory, moved
+    # over path when the block succeeds, so concurrent writers do not mix their
+    # output and readers never see a partial file.
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as fo:
+            yield fo
+        if not _file_mode:
+            # Permissions of a file created with open() (mkstemp makes it private)
+            umask = os.umask(0)
+            os.umask(umask)
+            _file_mode.append(0o666 & ~umask)
+        os.chmod(tmp_file, _file_mode[0])
+        os.replace(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def clear_reference_cache():
+    """Drop all references held in memory by fasta_to_dict."""
+    _ref_cache.clear()
+
+
+def _evict_references():
+    # Drop least recently used references until the cache fits its budget
+    while _ref_cache and sum(size for _, size in _ref_cache.values()) > _ref_cache_config['max_bytes']:
+        _ref_cache.popitem(last=False)
+
+
 def fasta_to_dict(ref_file):
+    """
+    Import a fasta file into a dictionary of SeqRecords, keyed by record id.
 
-    with open(ref_file, 'r') as handle:
-        return SeqIO.to_dict(SeqIO.parse(handle, 'fasta'))
+    Parsed files are kept in a process-wide LRU cache keyed by path, size and
+    modification time, so repeated calls cost nothing after the first one.
+    The returned dictionary is shared between callers and must not be
+    modified. See set_reference_cache for the memory budget and the optional
+    on-disk cache.
+    """
 
+    stat = os.stat(ref_file)
+    key = (os.path.abspath(ref_file), stat.st_size, stat.st_mtime)
 
-def from_mutpos(mutpos_file, ref_file, clonality=(0, 1), min_depth=100, kmer=3,
-                chromosome=None, start=0, end=None, notation='pyrimidine',
-                fmt='essigmann', verbose=False):
-    mutations = []
-    record_dict = fasta_to_dict(ref_file)
+    if key in _ref_cache:
+        _ref_cache.move_to_end(key)
+        return _ref_cache[key][0]
 
-    # Open the mutpos_file and read data line by line
-    with open(mutpos_file, 'r') as handle:
-        for line in handle:
-            # Strip newline characters and split on tabs
-            line = line.strip().split('\t')
-#            if isinstance(line[0],str):
-#                continue
+    disk_dir = _ref_cache_config['disk_dir']
+    disk_file = None
+    if disk_dir is not None:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        disk_file = os.path.join(disk_dir, digest + '.pkl')
 
-            # Unpack line and cast to proper data type
-            chrom, ref = str(line[0]), str(line[1]).upper()
-            position, depth = int(line[2]) - 1, int(line[3])
+    if disk_file is not None and os.path.exists(disk_file):
+        with open(disk_file, 'rb') as handle:
+            record_dict = pickle.load(handle)
+    else:
+        from Bio import SeqIO  # Biopython is only needed to parse fasta files
+        with open(ref_file, 'r') as handle:
+            record_dict = SeqIO.to_dict(SeqIO.parse(handle, 'fasta'))
+        if disk_file is not None:
+            with _atomic_file(disk_file) as fo:
+                pickle.dump(record_dict, fo, protocol=pickle.HIGHEST_PROTOCOL)
 
-            if chromosome is not None and chrom != chromosome:
-                continue
-            if position < start:
-                continue
-            if end is not None and position >= end:
+    size = sum(len(record) for record in record_dict.values())
+    if size <= _ref_cache_config['max_bytes']:
+        _ref_cache[key] = (record_dict, size)
+        _evict_references()
+    return record_dict
+
+
+class ReadStats:
+    """
+    Counters and timings collected by the MutLib readers.
+
+    Every reader takes an optional stats argument. It counts lines and bytes
+    read, sites skipped per filter reason and mutations emitted, and times
+    each stage. Nothing is printed: pass a callback (ie. stats_logger()) to
+    receive progress events, and use summary() or to_json() at the end.
+
+    Parameters
+    ----------
+    callback : callable or None
+        Called with an event dict ({'event', 'stage', 'elapsed', 'counters'})
+        after each chunk of input and at the end of each stage.
+    interval : int
+        Lines between progress events for readers that go line by line.
+    """
+
+    def __init__(self, callback=None, interval=100000):
+        self.callback = callback
+        self.interval = interval
+        self.counters = OrderedDict()
+        self.stages = OrderedDict()
+        self._stage, self._stage_start = None, None
+        self._start = time.perf_counter()
+
+    def count(self, name, n=1):
+        """Add n to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def skip(self, reason, n=1):
+        """Count n sites skipped for a reason (ie. 'min_depth')."""
+        if n:
+            self.count('skipped.' + reason, n)
+
+    def read(self, lines):
+        """Count a chunk of input lines and their size."""
+        self.count('lines', len(lines))
+        self.count('bytes', sum(len(line) for line in lines))
+
+    def begin(self, stage):
+        """Start timing a stage (ends the current one, if any)."""
+        self.end()
+        self._stage, self._stage_start = stage, time.perf_counter()
+
+    def end(self):
+        """Stop timing the current stage and report it."""
+        if self._stage is None:
+            return
+        elapsed = time.perf_counter() - self._stage_start
+        self.stages[self._stage] = self.stages.get(self._stage, 0) + elapsed
+        self.progress('end')
+        self._stage = None
+
+    def progress(self, event='progress'):
+        """Send an event with the current counters to the callback."""
+        if self.callback is None:
+            return
+        self.callback({'event': event, 'stage': self._stage,
+                       'elapsed': time.perf_counter() - self._start,
+                       'counters': dict(self.counters)})
+
+    def summary(self):
+        """Counters, stage timings and throughput as a dict."""
+        elapsed = time.perf_counter() - self._start
+        return {'counters': dict(self.counters),
+                'stages': dict(self.stages),
+                'elapsed': elapsed,
+                'lines_per_second': self.counters.get('lines', 0) / elapsed if elapsed else 0.0,
+                'bytes_per_second': self.counters.get('bytes', 0) / elapsed if elapsed else 0.0}
+
+    def to_json(self, outfile=None):
+        """Return the summary as JSON, and save it to outfile if given."""
+        text = json.dumps(self.summary(), indent=2)
+        if outfile is not None:
+            with open(outfile, 'w') as fo:
+                fo.write(text + '\n')
+        return text
+
+
+def stats_logger(logger=None, level=logging.INFO):
+    """
+    Callback for ReadStats that writes progress events to a logger
+    (default: the MutLib logger).
+    """
+    logger = logging.getLogger('MutLib') if logger is None else logger
+
+    def callback(event):
+        counters = ', '.join('{}={}'.format(k, v) for k, v in event['counters'].items())
+        logger.log(level, '%s %s (%.1fs): %s', event['stage'], event['event'],
+                   event['elapsed'], counters)
+    return callback
+
+
+def open_mut_file(mut_file):
+    """
+    Open a mutation file (.mut, .mutpos or table) for reading text lines.
+    Plain text, gzip and block-gzip (bgzip) files are all accepted.
+    """
+    with open(mut_file, 'rb') as handle:
+        magic = handle.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(mut_file, 'rt')
+    return open(mut_file, 'r')
+
+
+def _is_bgzf(mut_file):
+    # Block-gzip files are gzip files whose first member has a BC subfield
+    with open(mut_file, 'rb') as handle:
+        header = handle.read(18)
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+def _mut_file_type(mut_file):
+    # 'mutpos' or 'mut', from the extension of the file without its .gz / .bgz suffix
+    name = os.path.basename(mut_file)
+    for suffix in ('.gz', '.bgz'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    ext = os.path.splitext(name)[1]
+    if ext not in ('.mut', '.mutpos'):
+        raise ValueError('Unrecognized mutation file extension: {}'.format(mut_file))
+    return ext[1:]
+
+
+def _position_column(mut_file):
+    # Column holding the position: 2 in .mutpos files, 1 in .mut files
+    return 2 if _mut_file_type(mut_file) == 'mutpos' else 1
+
+
+def index_mut_file(mut_file, pos_col=None, index_file=None):
+    """
+    Build the sidecar position index (mut_file + '.mpi', or in the store
+    directory, see set_store_dir) of a bgzip compressed mutation file, used
+    by iter_mut_lines for region queries.
+
+    The index stores the virtual offset of the first line of every block and
+    of every chromosome change, with its chromosome and position. It also
+    records whether the file is sorted (each chromosome in one run, with
+    increasing positions); region queries on unsorted files scan the whole
+    file.
+
+    Returns the path of the index file.
+    """
+
+    if pos_col is None:
+        pos_col = _position_column(mut_file)
+    if index_file is None:
+        index_file = _derived_file(mut_file, '.mpi')
+
+    entries = []
+    is_sorted = True
+    seen = set()
+    last_chrom, last_block, last_pos = None, None, None
+
+    from Bio import bgzf
+    handle = bgzf.BgzfReader(mut_file, 'r')
+    try:
+        while True:
+            voffset = handle.tell()
+            line = handle.readline()
+            if not line:
+                break
+            row = line.split('\t', pos_col + 1)
+            if len(row) <= pos_col or not row[pos_col].strip().isdigit():
                 continue
+            chrom, pos = row[0], int(row[pos_col])
 
-            if fmt == 'essigmann':
-                A, C, G, T, N = map(int, line[4:9])
-            elif fmt == 'wesdirect':
-                # N = 0
-                thisMut = {base: 0 for base in dna_bases}
-                thisMut[str(line[5])] = int(line[4])
-                A = thisMut['A']
-                C = thisMut['C']
-                G = thisMut['G']
-                T = thisMut['T']
-            elif fmt == 'loeb':
-                T, C, G, A = map(int, line[5:9])
-                # N = int(line[11])
+            if chrom != last_chrom:
+                is_sorted &= chrom not in seen
+                seen.add(chrom)
+                entries.append((chrom, pos, voffset))
             else:
-                raise ValueError('Format must be essigmann, loeb, wesdirect')
+                is_sorted &= pos >= last_pos
+                if voffset >> 16 != last_block:
+                    entries.append((chrom, pos, voffset))
+            last_chrom, last_block, last_pos = chrom, voffset >> 16, pos
+    finally:
+        handle.close()
+
+    stat = os.stat(mut_file)
+    with _atomic_file(index_file, 'w') as fo:
+        fo.write('#mpi\t{}\t{}\t{}\t{}\n'.format(pos_col, int(is_sorted), stat.st_size, stat.st_mtime))
+        for chrom, pos, voffset in entries:
+            fo.write('{}\t{}\t{}\n'.format(chrom, pos, voffset))
+
+    return index_file
+
+
+def _load_mut_index(mut_file, pos_col):
+    # Read the sidecar index of a bgzip file, rebuilding it if it is missing,
+    # stale or was built for another position column.
+    # Returns (sorted flag, {chrom: (positions, virtual offsets)}).
+
+    stat = os.stat(mut_file)
+    for index_file in _derived_candidates(mut_file, '.mpi'):
+        header = None
+        if os.path.exists(index_file):
+            with open(index_file, 'r') as handle:
+                header = handle.readline().rstrip('\n').split('\t')
+        if header == ['#mpi', str(pos_col), header and header[2], str(stat.st_size), str(stat.st_mtime)]:
+            break
+    else:
+        index_file = index_mut_file(mut_file, pos_col)
 
-            # If we see no observed base substitutions, skip this loop
-            if sum([A, C, G, T]) == 0:
-                continue
+    index = OrderedDict()
+    with open(index_file, 'r') as handle:
+        is_sorted = handle.readline().split('\t')[2] == '1'
+        for line in handle:
+            chrom, pos, voffset = line.rstrip('\n').split('\t')
+            positions, voffsets = index.setdefault(chrom, ([], []))
+            positions.append(int(pos))
+            voffsets.append(int(voffset))
+    return is_sorted, index
 
-            # Read mapped depth (minus Ns) at this position must be greater
-            # than min_depth, if not, skip this loop
-            if min_depth > depth:
-                continue
 
-            # Get the kmer context at the given position in the given
-            # chromosome as looked up in record_dict. If we encounter an
-            # edge case (return of None) we'll skip this loop
-            context = str(get_kmer(record_dict, chrom, position, kmer)).upper()
-            print(context)
-            if context is None:
+def iter_mut_lines(mut_file, chromosome=None, start=None, end=None, pos_col=None):
+    """
+    Iterate over the lines of a mutation file (plain, gzip or bgzip).
+
+    If chromosome is given, only lines on that chromosome with
+    start <= position < end are returned (coordinates as written in the
+    position column of the file). For bgzip files the sidecar index (built on
+    first use, see index_mut_file) is used to seek straight to the region.
+    """
+
+    if chromosome is None:
+        with open_mut_file(mut_file) as handle:
+            for line in handle:
+                yield line
+        return
+
+    if pos_col is None:
+        pos_col = _position_column(mut_file)
+
+    def in_region(line):
+        row = line.split('\t', pos_col + 1)
+        if row[0] != chromosome or len(row) <= pos_col or not row[pos_col].strip().isdigit():
+            return False, False
+        pos = int(row[pos_col])
+        past = end is not None and pos >= end
+        return (start is None or pos >= start) and not past, past
+
+    if _is_bgzf(mut_file):
+        from Bio import bgzf
+        is_sorted, index = _load_mut_index(mut_file, pos_col)
+        if is_sorted:
+            if chromosome not in index:
+                return
+            positions, voffsets = index[chromosome]
+            i = max(bisect_right(positions, start if start is not None else -1) - 1, 0)
+
+            handle = bgzf.BgzfReader(mut_file, 'r')
+            try:
+                handle.seek(voffsets[i])
+                for line in handle:
+                    if not line.startswith(chromosome + '\t'):
+                        break
+                    keep, past = in_region(line)
+                    if past:
+                        break
+                    if keep:
+                        yield line
+            finally:
+                handle.close()
+            return
+
+    with open_mut_file(mut_file) as handle:
+        for line in handle:
+            if in_region(line)[0]:
+                yield line
+
+
+def from_mutpos(mutpos_file, ref_file, clonality=(0, 1), min_depth=100, kmer=3,
+                chromosome=None, start=0, end=None, notation='pyrimidine',
+                fmt='essigmann', verbose=False, stats=None):
+    stats = ReadStats() if stats is None else stats
+    mutations = []
+    stats.begin('reference')
+    record_dict = open_reference(ref_file)
+    stats.begin('from_mutpos')
+
+    # Region queries on bgzip files seek straight to the region
+    lines = iter_mut_lines(mutpos_file, chromosome, start + 1,
+                           None if end is None else end + 1, pos_col=2)
+
+    # Read the mutpos_file data line by line
+    for line in lines:
+        stats.read([line])
+        if stats.counters['lines'] % stats.interval == 0:
+            stats.progress()
+
+        # Strip newline characters and split on tabs
+        line = line.strip().split('\t')
+#            if isinstance(line[0],str):
+#                continue
+
+        # Unpack line and cast to proper data type
+        chrom, ref = str(line[0]), str(line[1]).upper()
+        position, depth = int(line[2]) - 1, int(line[3])
+
+        if chromosome is not None and chrom != chromosome:
+            stats.skip('region')
+            continue
+        if position < start:
+            stats.skip('region')
+            continue
+        if end is not None and position >= end:
+            stats.skip('region')
+            continue
+
+        if fmt == 'essigmann':
+            A, C, G, T, N = map(int, line[4:9])
+        elif fmt == 'wesdirect':
+            # N = 0
+            thisMut = {base: 0 for base in dna_bases}
+            thisMut[str(line[5])] = int(line[4])
+            A = thisMut['A']
+            C = thisMut['C']
+            G = thisMut['G']
+            T = thisMut['T']
+        elif fmt == 'loeb':
+            T, C, G, A = map(int, line[5:9])
+            # N = int(line[11])
+        else:
+            raise ValueError('Format must be essigmann, loeb, wesdirect')
+
+        # If we see no observed base substitutions, skip this loop
+        if sum([A, C, G, T]) == 0:
+            stats.skip('no_mutation')
+            continue
+
+        # Read mapped depth (minus Ns) at this position must be greater
+        # than min_depth, if not, skip this loop
+        if min_depth > depth:
+            stats.skip('min_depth')
+            continue
+
+        # Get the kmer context at the given position in the given
+        # chromosome as looked up in record_dict. If we encounter an
+        # edge case (return of None) we'll skip this loop
+        context = get_kmer(record_dict, chrom, position, kmer)
+        if context is None:
+            stats.skip('edge')
+            continue
+        context = context.upper()
+
+        # If the base is not in our intended labeling set: let's get
+        # the complement of the reference base, the reverse complement
+        # of the trinucleotide context, and the mutation counts for the
+        # complement of the base substitution observed
+        if (
+            (notation == 'purine' and ref in pyrimidines) or
+            (notation == 'pyrimidine' and ref in purines)
+        ):
+            ref = str(reverse_complement(ref))
+            context = str(reverse_complement(context))
+            A, G, C, T = T, C, G, A
+
+        for base, num_mutations in zip(dna_bases, [A, C, G, T]):
+            # Clonality is defined as the frequency of any base
+            # substitution at this one genomic position. For example, if
+            # there are 5% T, 10% C, and 100% G in a reference position of
+            # A, we can seletion a clonality filter of (0.1, 0.5) to
+            # eliminate the rare T mutations and clonal G mutations.
+            base_clonality = num_mutations / depth
+            if not min(clonality) <= base_clonality <= max(clonality):
+                stats.skip('clonality')
                 continue
 
-            # If the base is not in our intended labeling set: let's get
-            # the complement of the reference base, the reverse complement
-            # of the trinucleotide context, and the mutation counts for the
-            # complement of the base substitution observed
-            if (
-                (notation == 'purine' and ref in pyrimidines) or
-                (notation == 'pyrimidine' and ref in purines)
-            ):
-                ref = str(reverse_complement(ref))
-                context = str(reverse_complement(context))
-                A, G, C, T = T, C, G, A
-
-            for base, num_mutations in zip(dna_bases, [A, C, G, T]):
-                # Clonality is defined as the frequency of any base
-                # substitution at this one genomic position. For example, if
-                # there are 5% T, 10% C, and 100% G in a reference position of
-                # A, we can seletion a clonality filter of (0.1, 0.5) to
-                # eliminate the rare T mutations and clonal G mutations.
-                base_clonality = num_mutations / depth
-                if not min(clonality) <= base_clonality <= max(clonality):
-                    continue
-
-                for _ in range(num_mutations):
-                    mutation = Mutation(ref, base, chrom, position, context)
-                    mutation.depth, mutation.clonality = depth, base_clonality
-                    mutations.append(mutation)
-                    print(mutation.context)
+            for _ in range(num_mutations):
+                mutation = Mutation(ref, base, chrom, position, context)
+                mutation.depth, mutation.clonality = depth, base_clonality
+                mutations.append(mutation)
+            stats.count('mutations', num_mutations)
 
+    stats.end()
     if verbose is True:
         print('Found {} Mutations'.format(len(mutations)))
     return mutations
 
 
+class RefStore:
+    """
+    Memory-mapped, 2-bit packed copy of a FASTA reference.
+
+    Bases are packed four per byte (A=0, C=1, G=2, T=3) with a separate
+    one-bit-per-base mask for N (or any other non-ACGT letter), so slicing a
+    k-mer only touches the few bytes that hold it. Case is not preserved.
+    Use open_reference() to get a store for a FASTA file; it is built on
+    first use and reused afterwards.
+
+    File layout: 16-byte magic, then for each contig its packed bases and its
+    packed N-mask (each starting on a byte boundary), then a JSON contig
+    table, and finally the offset of that table as a little-endian uint64.
+    """
+
+    magic = b'MUTLIB-REFPACK1\n'
+    ext = '.rpk'
+
+    def __init__(self, store_file):
+        self.path = store_file
+        with open(store_file, 'rb') as handle:
+            if handle.read(len(self.magic)) != self.magic:
+                raise ValueError('{} is not a packed reference'.format(store_file))
+            handle.seek(-8, os.SEEK_END)
+            table_offset = int.from_bytes(handle.read(8), 'little')
+            handle.seek(table_offset)
+            self.info = json.loads(handle.read()[:-8].decode())
+
+        self._data = np.memmap(store_file, dtype=np.uint8, mode='r')
+        self.contigs = OrderedDict((name, (length, seq_off, mask_off))
+                                   for name, length, seq_off, mask_off
+                                   in self.info['contigs'])
+
+    def __contains__(self, chrom):
+        return chrom in self.contigs
+
+    def __iter__(self):
+        return iter(self.contigs)
+
+    def __len__(self):
+        return len(self.contigs)
+
+    def keys(self):
+        return self.contigs.keys()
+
+    def length(self, chrom):
+        """Length of a contig."""
+        return self.contigs[chrom][0]
+
+    def codes(self, chrom, start, end):
+        """
+        Base codes (0-3 for ACGT, 4 for N) of chrom[start:end], as uint8.
+        Coordinates must be within the contig.
+        """
+        length, seq_off, mask_off = self.contigs[chrom]
+        if not 0 <= start <= end <= length:
+            raise ValueError(
+                'Interval {}-{} outside of {} (length {})'.format(start, end, chrom, length))
+        if start == end:
+            return np.zeros(0, dtype=np.uint8)
+
+        packed = self._data[seq_off + start // 4: seq_off + (end - 1) // 4 + 1]
+        codes = ((packed[:, None] >> np.array([6, 4, 2, 0], dtype=np.uint8)) & 3).ravel()
+        codes = codes[start % 4: start % 4 + end - start]
+
+        nmask = np.unpackbits(self._data[mask_off + start // 8: mask_off + (end - 1) // 8 + 1])
+        codes[nmask[start % 8: start % 8 + end - start].astype(bool)] = 4
+        return codes
+
+    def gather(self, chrom, starts, k):
+        """
+        Base codes of the k-mers chrom[s:s+k] for every s in starts, as a
+        (len(starts), k) uint8 array, gathered in one fancy-indexing pass.
+        All windows must be within the contig.
+        """
+        length, seq_off, mask_off = self.contigs[chrom]
+        idx = np.asarray(starts, dtype=np.int64)[:, None] + np.arange(k)
+
+        packed = self._data[seq_off + (idx >> 2)]
+        codes = (packed >> (6 - 2 * (idx & 3)).astype(np.uint8)) & 3
+
+        nmask = (self._data[mask_off + (idx >> 3)] >> (7 - (idx & 7)).astype(np.uint8)) & 1
+        codes[nmask.astype(bool)] = 4
+        return codes
+
+    def fetch(self, chrom, start, end):
+        """Sequence of chrom[start:end] as an upper case string."""
+        return _code_letters[self.codes(chrom, start, end)].tobytes().decode()
+
+    @classmethod
+    def build(cls, ref_file, store_file=None):
+        """
+        Pack a FASTA file into a store file (default: ref_file + '.rpk', or in
+        the store directory, see set_store_dir). The FASTA is streamed one contig
+        at a time. Returns the opened store.
+        """
+        if store_file is None:
+            store_file = _derived_file(ref_file, cls.ext)
+        stat = os.stat(ref_file)
+        contigs = []
+
+        with _atomic_file(store_file) as fo:
+            fo.write(cls.magic)
+
+            for name, seq in _iter_fasta(ref_file):
+                codes = base_codes[np.frombuffer(seq, dtype=np.uint8)]
+                nmask = codes == 4
+                codes[nmask] = 0
+
+                padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+                padded[:len(codes)] = codes
+                packed = (padded[0::4] << 6) | (padded[1::4] << 4) | (padded[2::4] << 2) | padded[3::4]
+
+                seq_off = fo.tell()
+                fo.write(packed.tobytes())
+                mask_off = fo.tell()
+                fo.write(np.packbits(nmask).tobytes())
+                contigs.append([name, len(codes), seq_off, mask_off])
+
+            table_offset = fo.tell()
+            fo.write(json.dumps({'source': os.path.abspath(ref_file),
+                                 'size': stat.st_size,
+                                 'mtime': stat.st_mtime,
+                                 'contigs': contigs}).encode())
+            fo.write(table_offset.to_bytes(8, 'little'))
+
+        return cls(store_file)
+
+
+_code_letters = np.frombuffer(b'ACGTN', dtype=np.uint8)
+
+
+def _iter_fasta(ref_file):
+    # Stream (name, sequence bytes) records from a FASTA file. The name is
+    # the first word of the header line, as in SeqIO record ids.
+    name, chunks = None, []
+    with open(ref_file, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(chunks)
+                name, chunks = line[1:].split(None, 1)[0].decode(), []
+            else:
+                chunks.append(line.strip())
+    if name is not None:
+        yield name, b''.join(chunks)
+
+
+def open_reference(ref_file, store_file=None, rebuild=False):
+    """
+    Return a RefStore for a FASTA file, packing it first if the store is
+    missing or older than the FASTA. A path to an existing store file is
+    opened directly. The store is ref_file + '.rpk' unless store_file is
+    given, or a store directory is set or needed (see set_store_dir).
+    """
+    if ref_file.endswith(RefStore.ext):
+        return RefStore(ref_file)
+
+    candidates = [store_file] if store_file is not None else _derived_candidates(ref_file, RefStore.ext)
+    if not rebuild:
+        stat = os.stat(ref_file)
+        for candidate in candidates:
+            if os.path.exists(candidate):
+                store = RefStore(candidate)
+                if store.info['size'] == stat.st_size and store.info['mtime'] == stat.st_mtime:
+                    return store
+
+    return RefStore.build(ref_file, candidates[0])
+
+
+class MutSites:
+    """
+    Columnar table of base substitutions read from a .mutpos file.
+
+    Each row is one (site, alternate base) pair weighted by the number of
+    reads that support it, so a clonal site with thousands of reads is a
+    single row rather than thousands of objects.
+
+    Attributes
+    ----------
+    chroms : list of str
+        Chromosome names; the chrom column holds indices into this list.
+    chrom, pos, ref, alt, count, depth, clonality, flip : numpy.ndarray
+        One value per row. Positions are 0-based, ref and alt are base codes
+        (indices in dna_bases), flip marks rows that were complemented to
+        match the requested notation.
+    """
+
+    columns = OrderedDict([('chrom', np.int32), ('pos', np.int64),
+                           ('ref', np.uint8), ('alt', np.uint8),
+                           ('count', np.int64), ('depth', np.int64),
+                           ('clonality', np.float64), ('flip', np.bool_)])
+
+    def __init__(self, chroms, **data):
+        self.chroms = list(chroms)
+        for name, dtype in self.columns.items():
+            setattr(self, name, np.asarray(data.get(name, []), dtype=dtype))
+
+    def __len__(self):
+        return len(self.pos)
+
+    def total(self):
+        """Total number of supporting reads over all rows."""
+        return int(self.count.sum())
+
+    def chrom_names(self):
+        """Chromosome name of every row."""
+        return np.asarray(self.chroms, dtype=object)[self.chrom]
+
+    def mut_labels(self):
+        """Mutation label (ie. C>T) of every row."""
+        bases = np.array(dna_bases, dtype=object)
+        return bases[self.ref] + '>' + bases[self.alt]
+
+
+def _parse_mutpos_chunk(lines, fmt):
+    # Split a chunk of .mutpos lines into chrom, ref, position, depth and a
+    # (n, 4) matrix of read counts for A, C, G, T.
+
+    ncols = {'essigmann': 8, 'loeb': 9, 'wesdirect': 6}
+    if fmt not in ncols:
+        raise ValueError('Format must be essigmann, loeb, wesdirect')
+
+    rows = [line.rstrip('\r\n').split('\t') for line in lines]
+    rows = [row for row in rows if len(row) >= ncols[fmt] and row[2].isdigit()]
+
+    chroms = [row[0] for row in rows]
+    refs = ''.join(row[1][:1] for row in rows).encode()
+    position = np.array([row[2] for row in rows], dtype=np.int64) - 1
+    depth = np.array([row[3] for row in rows], dtype=np.int64)
+
+    if fmt == 'essigmann':
+        counts = np.array([row[4:8] for row in rows], dtype=np.int64)
+    elif fmt == 'loeb':
+        # Loeb column order is T, C, G, A
+        counts = np.array([row[5:9] for row in rows], dtype=np.int64).reshape(-1, 4)[:, loeb_order]
+    elif fmt == 'wesdirect':
+        counts = np.zeros((len(rows), 4), dtype=np.int64)
+        alt = base_codes[np.frombuffer(
+            ''.join(row[5][:1] for row in rows).encode(), dtype=np.uint8)]
+        ok = alt < 4
+        counts[np.nonzero(ok)[0], alt[ok]] = [int(row[4]) for row, o in zip(rows, ok) if o]
+
+    ref = base_codes[np.frombuffer(refs, dtype=np.uint8)]
+    return chroms, ref, position, depth, counts.reshape(len(rows), 4)
+
+
+def load_mutpos(mutpos_file, clonality=(0, 1), min_depth=100, chromosome=None,
+                start=0, end=None, notation='pyrimidine', fmt='essigmann',
+                chunksize=100000, stats=None):
+    """
+    Load a .mutpos file into a columnar, count-weighted MutSites table.
+
+    The file is parsed in chunks of lines into NumPy arrays, applying the
+    same filters as from_mutpos, so memory grows with the number of mutated
+    sites rather than the number of mutant reads.
+
+    Parameters
+    ----------
+    mutpos_file : str
+        Path to the .mutpos file (plain text, gzip or bgzip).
+    clonality : tuple of float
+        Keep substitutions whose frequency (count / depth) is in this range.
+    min_depth : int
+        Minimum read depth at a site.
+    chromosome : str or None
+        Only keep sites on this chromosome.
+    start, end : int
+        Only keep sites with start <= position < end (0-based).
+    notation : 'pyrimidine' or 'purine'
+        Substitutions on the other strand are complemented (and flagged in
+        the flip column).
+    fmt : 'essigmann', 'loeb' or 'wesdirect'
+        Column layout of the file.
+    chunksize : int
+        Number of lines parsed per chunk.
+    stats : ReadStats or None
+        Collects counters and timings.
+
+    Returns
+    -------
+    sites : MutSites
+    """
+
+    stats = ReadStats() if stats is None else stats
+    stats.begin('load_mutpos')
+
+    if notation not in ('pyrimidine', 'purine'):
+        raise ValueError('Notation must be pyrimidine or purine')
+
+    low, high = min(clonality), max(clonality)
+    flip_codes = [base_codes[ord(b)] for b in
+                  (purines if notation == 'pyrimidine' else pyrimidines)]
+
+    chrom_index = OrderedDict()
+    parts = {name: [] for name in MutSites.columns}
+
+    # Region queries on bgzip files seek straight to the region
+    source = iter_mut_lines(mutpos_file, chromosome, start + 1,
+                            None if end is None else end + 1, pos_col=2)
+    while True:
+        lines = list(islice(source, chunksize))
+        if not lines:
+            break
+        stats.read(lines)
+
+        chroms, ref, position, depth, counts = _parse_mutpos_chunk(lines, fmt)
+        stats.count('sites', len(ref))
+
+        codes = np.array([chrom_index.setdefault(c, len(chrom_index))
+                          for c in chroms], dtype=np.int32)
+
+        keep = (ref < 4)
+        stats.skip('invalid_ref', np.count_nonzero(~keep))
+        region = position >= start
+        if end is not None:
+            region &= position < end
+        if chromosome is not None:
+            region &= codes == chrom_index.get(chromosome, -1)
+        stats.skip('region', np.count_nonzero(keep & ~region))
+        keep &= region
+        stats.skip('min_depth', np.count_nonzero(keep & (depth < min_depth)))
+        keep &= depth >= min_depth
+
+        # One row per observed substitution at each kept site
+        counts[np.arange(len(ref))[ref < 4], ref[ref < 4]] = 0
+        site, alt = np.nonzero(counts * keep[:, None])
+        count = counts[site, alt]
+        freq = count / depth[site]
+        ok = (freq >= low) & (freq <= high)
+        stats.skip('clonality', np.count_nonzero(~ok))
+        site, alt, count, freq = site[ok], alt[ok], count[ok], freq[ok]
+        stats.count('mutations', len(site))
+        stats.progress()
+
+        row_ref = ref[site]
+        flip = np.isin(row_ref, flip_codes)
+        row_ref = np.where(flip, comp_codes[row_ref], row_ref)
+        alt = np.where(flip, comp_codes[alt], alt)
+
+        for name, values in zip(MutSites.columns,
+                                (codes[site], position[site], row_ref, alt,
+                                 count, depth[site], freq, flip)):
+            parts[name].append(values)
+
+    stats.end()
+    data = {name: np.concatenate(values) if values else []
+            for name, values in parts.items()}
+    return MutSites(chrom_index.keys(), **data)
+
+
 def get_kmer(record_dict, chromosome, position, k=3, pos='mid'):
     """
     Given a dictionary (in memory) of fasta sequences this function will
@@ -140,9 +941,9 @@ def get_kmer(record_dict, chromosome, position, k=3, pos='mid'):
 
     Parameters
     ----------
-    record_dict : dict of Bio.Seq objects
-        Dictionary where keys are chromosomes and values are Bio.Seq
-        sequences.
+    record_dict : RefStore or dict of Bio.Seq objects
+        Packed reference (see open_reference), or dictionary where keys are
+        chromosomes and values are Bio.Seq sequences.
     chromosome : str
         Key to use when accessing the record_dict.
     position : int
@@ -169,23 +970,108 @@ def get_kmer(record_dict, chromosome, position, k=3, pos='mid'):
     start = position - pos
     end = position + (k - pos)
 
-    try:
-        chromosome_length = len(str(record_dict[chromosome].seq))
-    except ValueError:
+    if chromosome not in record_dict:
         raise ValueError(
             'Chromosome {} not found in reference'.format(chromosome))
 
+    if isinstance(record_dict, RefStore):
+        chromosome_length = record_dict.length(chromosome)
+    else:
+        chromosome_length = len(record_dict[chromosome])
+
     # It is necessary to protect for the two edge cases now
     if start >= 0 and end <= chromosome_length:
-        try:
-            return str(record_dict[chromosome].seq[start:end])
-        except ValueError:
-            ValueError(
-                'Position {} not found in chromosome {}'.format(
-                    start, chromosome))
+        if isinstance(record_dict, RefStore):
+            return record_dict.fetch(chromosome, start, end)
+        return str(record_dict[chromosome].seq[start:end])
     else:
         return None
 
+def get_kmers(record_source, chrom_codes, positions, k=3, pos='mid',
+              chroms=None, encoded=False):
+    """
+    Batch version of get_kmer: extract the kmers around arrays of positions.
+
+    Windows are gathered per contig in a single NumPy indexing pass, so the
+    cost per site is a few array operations rather than a Python call.
+
+    Parameters
+    ----------
+    record_source : RefStore or dict of Bio.Seq objects
+        Reference to read from (see open_reference).
+    chrom_codes : array of int
+        Index of the chromosome of each position in chroms.
+    positions : array of int
+        0-based positions to query.
+    k : int
+        Length of kmer.
+    pos : 'mid' or int
+        Position in kmer that the genomic position should be centered on.
+    chroms : list of str
+        Chromosome names for chrom_codes. Defaults to the reference keys in
+        order (ie. MutSites.chroms can be passed here).
+    encoded : bool
+        If True, return kmers as base-4 integers (A=0, C=1, G=2, T=3, first
+        base most significant) instead of bytes.
+
+    Returns
+    -------
+    kmers : numpy.ndarray
+        Array of dtype S<k> (view it as uint8 for a (n, k) matrix), or of
+        int64 codes if encoded. Invalid entries are empty / -1.
+    valid : numpy.ndarray of bool
+        False where the window runs off the contig, the chromosome is not in
+        the reference or (if encoded) the kmer contains an N.
+    """
+
+    if pos == 'mid' and k % 2 != 1:
+        raise ValueError("Even length DNA has no midpoint")
+
+    if pos == 'mid':
+        pos = int((k - 1) / 2)
+
+    assert k > pos, "Cannot index past length of k"
+
+    if chroms is None:
+        chroms = list(record_source.keys())
+
+    chrom_codes = np.asarray(chrom_codes, dtype=np.int64)
+    starts = np.asarray(positions, dtype=np.int64) - pos
+
+    codes = np.full((len(starts), k), 4, dtype=np.uint8)
+    valid = np.zeros(len(starts), dtype=bool)
+
+    for code in np.unique(chrom_codes):
+        chrom = chroms[code]
+        if chrom not in record_source:
+            continue
+
+        if isinstance(record_source, RefStore):
+            length = record_source.length(chrom)
+        else:
+            seq = base_codes[np.frombuffer(str(record_source[chrom].seq).encode(), dtype=np.uint8)]
+            length = len(seq)
+
+        rows = np.nonzero(chrom_codes == code)[0]
+        rows = rows[(starts[rows] >= 0) & (starts[rows] + k <= length)]
+        valid[rows] = True
+
+        if isinstance(record_source, RefStore):
+            codes[rows] = record_source.gather(chrom, starts[rows], k)
+        else:
+            codes[rows] = seq[starts[rows][:, None] + np.arange(k)]
+
+    if encoded:
+        valid &= (codes < 4).all(axis=1)
+        kmers = (codes.astype(np.int64) * 4 ** np.arange(k - 1, -1, -1)).sum(axis=1)
+        kmers[~valid] = -1
+        return kmers, valid
+
+    letters = _code_letters[codes]
+    letters[~valid] = 0
+    return letters.view('S{}'.format(k)).ravel(), valid
+
+
 def rev_comp(sequence):
     """
     Returns the reverse complement of the sequence, a DNA sequence string.
@@ -200,87 +1086,245 @@ def rev_comp(sequence):
 
 
 
-def extract_mutpos_contexts (mutpos_file, ref_file, outfile, mut_type, window):
-    # Extract the sequence contexts around a specific type of mutation (mut_type)
-    # Window specifies the +/- size around central base (ie. window=1 is trinucleotide, window=2, pentanucleotides, etc)
-    # Outfile is a text output.
-    # mut_type is a string, in the form C>T, etc.
+def rev_comp_kmers(kmers):
+    """
+    Reverse complement an array of fixed-width kmers (dtype S<k>, as returned
+    by get_kmers). Empty entries stay empty.
+    """
+    k = kmers.dtype.itemsize
+    letters = kmers.view(np.uint8).reshape(-1, k)[:, ::-1]
+    return _comp_letters[letters].view('S{}'.format(k)).ravel()
+
+
+_comp_letters = np.arange(256, dtype=np.uint8)
+for _a, _b in zip(b'ACGTNacgtn', b'TGCANtgcan'):
+    _comp_letters[_a] = _b
+# Trailing zeros of short (invalid) entries end up at the front once
+# reversed; map them to themselves so those entries stay empty.
+_comp_letters[0] = 0
+
 
-    ref_dict = fasta_to_dict(ref_file)
+def _mut_code(mut_type):
+    # Integer code ref*4+alt of a mutation label such as 'C>T'
+    return dna_bases.index(mut_type[0]) * 4 + dna_bases.index(mut_type[2])
 
-    # Check for valid mutation type
 
-    if mut_type not in all_muts:
-        raise ValueError('Mut_type is not valid')
+class ProbeIndex:
+    """
+    Index of probe-based reference keys (ie chr1:xxx-yyy) by chromosome.
+
+    Resolves a genomic coordinate to the probe that contains it and the
+    offset within that probe by bisection over the sorted probe starts, in
+    O(log P) for P probes on the chromosome. Probes are assumed not to
+    overlap. Keys that do not end in :start-end are taken to span a whole
+    chromosome.
+    """
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        probes = {}
+        for i, key in enumerate(self.keys):
+            # Contig names may contain ':' too (ie HLA-A*01:01:01:01), so only
+            # a trailing :start-end makes a probe
+            chrom, _, interval = key.rpartition(':')
+            start, _, end = interval.partition('-')
+            if chrom and start.isdigit() and end.isdigit():
+                probes.setdefault(chrom, []).append((int(start), int(end), i))
+            else:
+                probes.setdefault(key, []).append((0, np.iinfo(np.int64).max, i))
+
+        self.probes = {}
+        for chrom, intervals in probes.items():
+            starts, ends, idx = zip(*sorted(intervals))
+            self.probes[chrom] = (np.array(starts, dtype=np.int64),
+                                  np.array(ends, dtype=np.int64),
+                                  np.array(idx, dtype=np.int64))
+
+    def locate(self, chrom, position):
+        """
+        Return (probe key, offset) for a genomic position, or (None, 0) if no
+        probe contains it.
+        """
+        if chrom not in self.probes:
+            return None, 0
+        starts, ends, idx = self.probes[chrom]
+        i = bisect_right(starts, position) - 1
+        if i < 0 or position >= ends[i]:
+            return None, 0
+        return self.keys[idx[i]], position - int(starts[i])
+
+    def locate_many(self, chroms, positions):
+        """
+        Vectorized locate for arrays of chromosomes and positions.
+
+        Returns
+        -------
+        key_codes : numpy.ndarray of int
+            Index of the probe in self.keys (-1 where not found).
+        offsets : numpy.ndarray of int
+            Offset within the probe.
+        found : numpy.ndarray of bool
+        """
+        chroms = np.asarray(chroms, dtype=object)
+        positions = np.asarray(positions, dtype=np.int64)
+        key_codes = np.full(len(positions), -1, dtype=np.int64)
+        offsets = np.zeros(len(positions), dtype=np.int64)
+
+        for chrom in set(chroms):
+            if chrom not in self.probes:
+                continue
+            starts, ends, idx = self.probes[chrom]
+            rows = np.nonzero(chroms == chrom)[0]
+            i = np.searchsorted(starts, positions[rows], side='right') - 1
+            hit = (i >= 0) & (positions[rows] < ends[np.maximum(i, 0)])
+            rows, i = rows[hit], i[hit]
+            key_codes[rows] = idx[i]
+            offsets[rows] = positions[rows] - starts[i]
+
+        return key_codes, offsets, key_codes >= 0
+
+
+def _parse_contexts_chunk(lines, file_type, probe_index):
+    # Parse a chunk of .mutpos (Loeb layout) or .mut lines into reference
+    # chromosome names, 0-based reference positions and mutation codes.
+
+    rows = [line.rstrip('\r\n').split('\t') for line in lines]
+
+    if file_type == 'mutpos':
+        rows = [row for row in rows if len(row) > 8 and row[2].isdigit()]
+        chroms = [row[0] for row in rows]
+        positions = np.array([row[2] for row in rows], dtype=np.int64) - 1
+        ref = base_codes[np.frombuffer(''.join(row[1][:1] for row in rows).encode(), dtype=np.uint8)]
+
+        # Loeb columns T, C, G, A; when several are non-zero the last one wins
+        counts = np.array([row[5:9] for row in rows], dtype=np.int64).reshape(-1, 4)
+        alt = np.full(len(rows), 4, dtype=np.uint8)
+        for col, base in enumerate(loeb_bases):
+            alt[counts[:, col] > 0] = dna_bases.index(base)
+
+    elif file_type == 'mut':
+        rows = [row for row in rows if len(row) > 6 and row[4] == 'snv']
+        ref = base_codes[np.frombuffer(''.join(row[5][:1] for row in rows).encode(), dtype=np.uint8)]
+        alt = base_codes[np.frombuffer(''.join(row[6][:1] for row in rows).encode(), dtype=np.uint8)]
+
+        # Map genomic coordinates to the probe keys of the reference
+        key_codes, positions, found = probe_index.locate_many(
+            [row[0] for row in rows], [row[1] for row in rows])
+        chroms = [probe_index.keys[code] if ok else None
+                  for code, ok in zip(key_codes, found)]
 
-    #find complementary mutation
-    if mut_type in py_muts:
-        comp_mut = pu_muts[py_muts.index(mut_type)]
     else:
-        comp_mut = py_muts[pu_muts.index(mut_type)]  
-    
-        
-    
-    # Calculate kmer length
-    kmer_len = window*2+1
-    
-    # Open output file
-    fo = open(outfile, "w")
+        raise ValueError('File type must be mutpos or mut')
 
+    mut = np.where((ref < 4) & (alt < 4), ref.astype(np.int64) * 4 + alt, -1)
+    return chroms, positions, mut
 
-    # Open the mutpos_file and read data line by line
-    with open(mutpos_file, 'r') as handle:
-        for line in handle:
-            # Strip newline characters and split on tabs
-            line = line.strip().split('\t')
-#            if isinstance(line[0],str):
-#                continue
 
-            # Unpack line and cast to proper data type
-            chrom, ref = str(line[0]), str(line[1]).upper()
-            position, depth = int(line[2]) - 1, int(line[3])
+def extract_contexts(mut_file, ref_file, outfiles, window, file_type='mutpos',
+                     chunksize=100000, stats=None):
+    """
+    Extract the sequence contexts around several mutation types in one pass.
 
-##            if chromosome is not None and chrom != chromosome:
-##                continue
-##            if position < start:
-##                continue
-##            if end is not None and position >= end:
-##                continue
+    The input is streamed once; each mutation is routed to the output of its
+    own type and, reverse complemented, to the output of the complementary
+    type (ie. a G>A mutation goes reverse complemented to the C>T output).
 
-           #format is Loeb
-            T, C, G, A = map(int, line[5:9])
-            # N = int(line[11])
-            
-            # If we see no observed base substitutions, skip this loop
-            if sum([A, C, G, T]) == 0:
-                continue
+    Parameters
+    ----------
+    mut_file : str
+        .mutpos file (Loeb layout) or TwinStrand .mut file.
+    ref_file : str
+        Reference FASTA. For .mut files, the FASTA keys are assumed to be the
+        probe coordinates (ie chr1:xxx-yyy) rather than entire chromosomes.
+    outfiles : dict
+        Mapping of mutation type (ie. 'C>T', any of all_muts) to output path.
+        Each output gets one context per line.
+    window : int
+        +/- size around central base (ie. window=1 is trinucleotide,
+        window=2 pentanucleotides, etc).
+    file_type : 'mutpos' or 'mut'
+        Layout of mut_file.
+    chunksize : int
+        Number of lines processed per chunk.
+    stats : ReadStats or None
+        Collects counters and timings.
+
+    Returns
+    -------
+    counts : dict
+        Number of contexts written for each mutation type.
+    """
 
-            if T>0:
-                mut = ref+">T"
-            if C>0:
-                mut = ref+">C"
-            if G>0:
-                mut = ref+">G"
-            if A>0:
-                mut = ref+">A"
+    stats = ReadStats() if stats is None else stats
 
+    for mut_type in outfiles:
+        if mut_type not in all_muts:
+            raise ValueError('Mut_type is not valid')
 
-            context = get_kmer(ref_dict, chrom, position, kmer_len)
+    stats.begin('reference')
+    ref_dict = open_reference(ref_file)
+    probe_index = ProbeIndex(ref_dict.keys()) if file_type == 'mut' else None
 
-            if mut == mut_type:
+    # Calculate kmer length
+    kmer_len = window*2+1
 
-##              print (mut, " ", context)
-##                print(context)
-                fo.write(context+"\n")
-                continue
+    routes = [(mut_type, _mut_code(mut_type), _mut_code(comp_muts[mut_type]))
+              for mut_type in outfiles]
+    counts = OrderedDict((mut_type, 0) for mut_type in outfiles)
+    stats.begin('extract_contexts')
+
+    with ExitStack() as stack:
+        handles = {mut_type: stack.enter_context(open(path, 'w', buffering=1 << 20))
+                   for mut_type, path in outfiles.items()}
+
+        with open_mut_file(mut_file) as handle:
+            while True:
+                lines = list(islice(handle, chunksize))
+                if not lines:
+                    break
+                stats.read(lines)
+
+                chroms, positions, mut = _parse_contexts_chunk(lines, file_type, probe_index)
+                stats.count('sites', len(chroms))
+                stats.skip('outside_reference', sum(chrom not in ref_dict for chrom in chroms))
+                names = OrderedDict.fromkeys(chroms)
+                codes = {chrom: i for i, chrom in enumerate(names)}
+                contexts, valid = get_kmers(ref_dict, [codes[chrom] for chrom in chroms],
+                                            positions, kmer_len, chroms=list(names))
+                stats.skip('edge', np.count_nonzero(~valid))
+
+                for mut_type, code, comp_code in routes:
+                    same = valid & (mut == code)
+                    comp = valid & (mut == comp_code)
+
+                    # Keep input order within the chunk
+                    out = contexts.copy()
+                    out[comp] = rev_comp_kmers(contexts[comp])
+                    out = out[same | comp]
+
+                    if len(out):
+                        handles[mut_type].write(b'\n'.join(out).decode() + '\n')
+                    counts[mut_type] += len(out)
+                    stats.count('mutations', len(out))
+                stats.progress()
+
+    stats.end()
+    return counts
+
+
+def extract_mutpos_contexts (mutpos_file, ref_file, outfile, mut_type, window, stats=None):
+    # Extract the sequence contexts around a specific type of mutation (mut_type)
+    # Window specifies the +/- size around central base (ie. window=1 is trinucleotide, window=2, pentanucleotides, etc)
+    # Outfile is a text output.
+    # mut_type is a string, in the form C>T, etc.
+    #
+    # To extract several mutation types, use extract_contexts, which reads the file only once.
 
-            if mut == comp_mut:
-                revcontext = rev_comp(context)
-##                print(revcontext+"--rev")
-                fo.write(revcontext+"\n")
+    return extract_contexts(mutpos_file, ref_file, {mut_type: outfile}, window, file_type='mutpos',
+                            stats=stats)
 
 
-def extract_mut_contexts (mut_file, ref_file, outfile, mut_type, window):
+def extract_mut_contexts (mut_file, ref_file, outfile, mut_type, window, stats=None):
     # Extract the sequence contexts around a specific type of mutation (mut_type)
     # Window specifies the +/- size around central base (ie. window=1 is trinucleotide, window=2, pentanucleotides, etc)
     # Outfile is a text output.
@@ -290,120 +1334,216 @@ def extract_mut_contexts (mut_file, ref_file, outfile, mut_type, window):
     # 
     # The fasta ref file is assumed to have the coordinates of the probes (ie chr1:xxx-yyy), rather than the entire chrom
     # sequence.
-
-
-    ref_dict = fasta_to_dict(ref_file)
-
-    # extracting key names and start coordinates of probes
     #
-    dictkeys = list(ref_dict.keys())
-
-##    print(dictkeys)
+    # To extract several mutation types, use extract_contexts, which reads the file only once.
 
-    probestartlist=[]
-    chrlist=[]
+    return extract_contexts(mut_file, ref_file, {mut_type: outfile}, window, file_type='mut',
+                            stats=stats)
 
-    for key in dictkeys:
-        str1, str2 = key.split(':')
-        str3 = str2.split('-')[0]
-        chrlist.append(str1)
-        probestartlist.append(str3)
 
-##    print(chrlist)
-##    print (probestartlist)
+# Spectrum channel of each (ref, alt) pair in pyrimidine notation: index of
+# the mutation in py_muts (-1 for non-substitutions and purine refs)
+_py_mut_index = np.full((5, 5), -1, dtype=np.int64)
+for _i, _m in enumerate(py_muts):
+    _py_mut_index[dna_bases.index(_m[0]), dna_bases.index(_m[2])] = _i
 
-    
 
-    # Check for valid mutation type
+def msp_channels(k=3):
+    """
+    The 96 (mutation, context) channels of a trinucleotide spectrum in
+    pyrimidine notation, in the same order as PlotSpec.init_spec_dict().
+    Other odd context lengths k give 6 * 4**(k-1) channels.
+    """
+    flank = (k - 1) // 2
+    return [(mut, ''.join(five) + mut[0] + ''.join(three)) for mut in py_muts
+            for five in product(dna_bases, repeat=flank)
+            for three in product(dna_bases, repeat=flank)]
 
-    if mut_type not in all_muts:
-        raise ValueError('Mut_type is not valid')
 
-    #find complementary mutation
-    if mut_type in py_muts:
-        comp_mut = pu_muts[py_muts.index(mut_type)]
-    else:
-        comp_mut = py_muts[pu_muts.index(mut_type)]  
-    
-        
-    
-    # Calculate kmer length
-    kmer_len = window*2+1
-    
-    # Open output file
-    fo = open(outfile, "w")
+def _spectrum_channels(ref, alt, contexts):
+    # Channel index (-1 if invalid) of substitutions given ref and alt base
+    # codes and an (n, k) matrix of context base codes (genomic strand).
+    # Purine substitutions are converted to their pyrimidine equivalent.
 
+    k = contexts.shape[1]
+    flip = (ref == 0) | (ref == 2)
+    ref = np.where(flip, comp_codes[ref], ref)
+    alt = np.where(flip, comp_codes[alt], alt)
+    contexts = np.where(flip[:, None], comp_codes[contexts[:, ::-1]], contexts)
 
-    # Open the mut_file and read data line by line
-    with open(mut_file, 'r') as handle:
-        for line in handle:
-            # Strip newline characters and split on tabs
-            line = line.strip().split('\t')
-#            if isinstance(line[0],str):
-#                continue
+    middle = contexts[:, k // 2]
+    flanks = np.delete(contexts, k // 2, axis=1).astype(np.int64)
 
-            #Check for snv only
-            if line[4] != 'snv':
-                continue
+    mut = _py_mut_index[ref, alt]
+    ok = (mut >= 0) & (flanks < 4).all(axis=1) & (middle == ref)
+    index = (flanks * 4 ** np.arange(k - 2, -1, -1)).sum(axis=1)
+    return np.where(ok, mut * 4 ** (k - 1) + index, -1)
 
-            # Unpack line and cast to proper data type
-            chrom1, ref, alt = str(line[0]), str(line[5]).upper(), str(line[6]).upper()
-            pos1, depth = int(line[1]), int(line[8])
-            trinuc = line[11].upper()
 
-##            if chromosome is not None and chrom != chromosome:
-##                continue
-##            if position < start:
-##                continue
-##            if end is not None and position >= end:
-##                continue
+def mut_to_msp(mut_file, outfile=None, maxratio=1.0, mindepth=0, ref_file=None,
+               file_type=None, fmt='essigmann', count='unique', k=3, chunksize=100000,
+               stats=None):
+    """
+    Build a 96-channel trinucleotide spectrum (or a 6 * 4**(k-1) channel
+    spectrum for longer contexts) from a .mut or .mutpos file.
 
-            mut = ref+'>'+alt
+    The file is streamed in chunks and mutations are accumulated directly
+    into a count vector, so memory does not depend on the size of the input.
 
-            # Before calling get_kmer - we need to modify chrom to match the ref keys, and offset position.
+    Parameters
+    ----------
+    mut_file : str
+        TwinStrand .mut file or .mutpos file. Trinucleotide contexts of .mut
+        files are read from their context column unless ref_file is given;
+        other contexts are read from ref_file.
+    outfile : str or None
+        If given, the spectrum is saved there as a msp csv file, readable by
+        PlotSpec.read_msp_file.
+    maxratio : float
+        Maximum alt_depth / depth ratio, to exclude clonal mutations.
+    mindepth : int
+        Minimum read depth at the mutated position.
+    ref_file : str
+        Reference FASTA, required for .mutpos files and for k other than 3.
+        For .mut files, its keys are probe coordinates (ie chr1:xxx-yyy).
+    file_type : 'mut', 'mutpos' or None
+        Layout of mut_file. Taken from the extension (.mut or .mutpos, with
+        an optional .gz or .bgz suffix) if None.
+    fmt : 'essigmann', 'loeb' or 'wesdirect'
+        Column layout of a .mutpos file.
+    count : 'unique' or 'reads'
+        Count each mutation once, or weight it by its number of reads.
+    k : int
+        Length of the sequence contexts (odd).
+    chunksize : int
+        Number of lines processed per chunk.
+    stats : ReadStats or None
+        Collects counters and timings.
 
-            pos = 0 
+    Returns
+    -------
+    spectrum : numpy.ndarray
+        Mutation counts, in the order of msp_channels(k).
+    """
 
-            # Special case chr1
-            if chrom1=='chr1': # could be one of two keys
-                if pos1 < 100000000:
-                    chrom = dictkeys[0]
-                    pos = pos1 - int(probestartlist[0])
+    if file_type is None:
+        file_type = _mut_file_type(mut_file)
+    if file_type not in ('mut', 'mutpos'):
+        raise ValueError('File type must be mutpos or mut')
+    if count not in ('unique', 'reads'):
+        raise ValueError('Count must be unique or reads')
+    if (file_type == 'mutpos' or k != 3) and ref_file is None:
+        raise ValueError('A reference is needed for .mutpos files and k other than 3')
+
+    stats = ReadStats() if stats is None else stats
+    if ref_file is not None:
+        stats.begin('reference')
+        ref_dict = open_reference(ref_file)
+        probe_index = ProbeIndex(ref_dict.keys()) if file_type == 'mut' else None
+
+    stats.begin('mut_to_msp')
+    nchan = 6 * 4 ** (k - 1)
+    spectrum = np.zeros(nchan, dtype=np.int64)
+
+    with open_mut_file(mut_file) as handle:
+        while True:
+            lines = list(islice(handle, chunksize))
+            if not lines:
+                break
+            stats.read(lines)
+
+            if file_type == 'mut':
+                rows = [line.rstrip('\r\n').split('\t') for line in lines]
+                rows = [row for row in rows if len(row) > 11 and row[4] == 'snv']
+                ref = base_codes[np.frombuffer(''.join(row[5][:1] for row in rows).encode(), dtype=np.uint8)]
+                alt = base_codes[np.frombuffer(''.join(row[6][:1] for row in rows).encode(), dtype=np.uint8)]
+                alt_depth = np.array([row[7] for row in rows], dtype=np.int64)
+                depth = np.array([row[8] for row in rows], dtype=np.int64)
+                if ref_file is None:
+                    contexts = base_codes[np.frombuffer(
+                        ''.join(row[11][:3].ljust(3, 'N') for row in rows).encode(),
+                        dtype=np.uint8)].reshape(-1, 3)
                 else:
-                    chrom = dictkeys[1]
-                    pos = pos1 - int(probestartlist[1])
-                    
-            # it's one of the other chromosomes. 
-            elif chrom1 not in chrlist:  # Check if valid
-                print('Invalid chromosome label')
-                continue
+                    key_codes, positions, found = probe_index.locate_many(
+                        [row[0] for row in rows], [row[1] for row in rows])
+                    kmers, valid = get_kmers(ref_dict, np.maximum(key_codes, 0), positions, k,
+                                             chroms=probe_index.keys)
+                    contexts = base_codes[kmers.view(np.uint8).reshape(-1, k)]
+                    contexts[~(valid & found)] = 4
+
             else:
-                ind = chrlist.index(chrom1)
-                chrom = dictkeys[ind]
-                pos = pos1 - int(probestartlist[ind])
-                
+                chroms, ref, position, depth, counts = _parse_mutpos_chunk(lines, fmt)
+                valid_ref = ref < 4
+                counts[np.arange(len(ref))[valid_ref], ref[valid_ref]] = 0
+                site, alt = np.nonzero(counts)
+                alt = alt.astype(np.uint8)
+                alt_depth, ref, depth = counts[site, alt], ref[site], depth[site]
+
+                names = list(OrderedDict.fromkeys(chroms))
+                codes = {chrom: i for i, chrom in enumerate(names)}
+                chrom_codes = np.array([codes[chrom] for chrom in chroms], dtype=np.int64)
+                kmers, valid = get_kmers(ref_dict, chrom_codes[site], position[site], k,
+                                         chroms=names)
+                contexts = base_codes[kmers.view(np.uint8).reshape(-1, k)]
+                contexts[~valid] = 4
+
+            stats.count('sites', len(ref))
+            keep = (depth >= mindepth) & (depth > 0)
+            stats.skip('min_depth', np.count_nonzero(~keep))
+            ratio = alt_depth <= maxratio * np.maximum(depth, 1)
+            stats.skip('max_ratio', np.count_nonzero(keep & ~ratio))
+            keep &= ratio
+            channels = _spectrum_channels(ref, alt, contexts)
+            stats.skip('invalid_context', np.count_nonzero(keep & (channels < 0)))
+            keep &= channels >= 0
+
+            weights = alt_depth[keep] if count == 'reads' else None
+            spectrum += np.bincount(channels[keep], weights=weights,
+                                    minlength=nchan).astype(np.int64)
+            stats.count('mutations', np.count_nonzero(keep))
+            stats.progress()
+
+    stats.end()
+    if outfile is not None:
+        save_msp_file(outfile, spectrum, source=mut_file,
+                      info=[('Min depth', mindepth), ('Max ratio', maxratio),
+                            ('Counting', count)])
+    return spectrum
+
+
+def save_msp_file(outfile, spectrum, source=None, info=()):
+    """
+    Save a 96-channel count vector as a msp csv file: a header of 8 lines
+    (ending with the column names), followed by Mutation, Context, Count,
+    Proportion rows in the order of msp_channels(). Longer vectors are saved
+    with the channels of the matching context length.
+    """
 
-            if mut == mut_type:
+    spectrum = np.asarray(spectrum)
+    k = 1 + 2 * int(round(np.log(len(spectrum) / 6) / np.log(16)))
+    total = spectrum.sum()
+    proportions = spectrum / total if total > 0 else np.zeros(len(spectrum))
 
-                context = get_kmer(ref_dict, chrom, pos, kmer_len)
-##              print (mut, " ", context)
-##                print(context.upper()+"\t"+trinuc)
-##                print('{} {} {} {} {} {} {}'.format(mut, pos1, chrom1, pos, chrom, trinuc, context))
-                fo.write(context.upper()+"\n")
-                continue
+    header = ['##MSP mutational spectrum file, generated by MutLib.mut_to_msp',
+              '##Source: {}'.format(source),
+              '##Total mutations: {}'.format(total),
+              '##Notation: pyrimidine']
+    header += ['##{}: {}'.format(key, value) for key, value in info]
+    header = (header + ['##'] * 7)[:7] + ['Mutation,Context,Count,Proportion']
 
-            if mut == comp_mut:
-                context = get_kmer(ref_dict, chrom, pos, kmer_len)
-                revcontext = rev_comp(context.upper())
-##                print(revcontext+"--rev\t"+trinuc)
-##                print('{} {} {} {} {} {} {} {}'.format(mut, pos1, chrom1, pos, chrom, trinuc, context, revcontext))
-                fo.write(revcontext+"\n")
+    with open(outfile, 'w') as fo:
+        fo.write('\n'.join(header) + '\n')
+        for (mut, con), value, prop in zip(msp_channels(k), spectrum, proportions):
+            fo.write(','.join([mut, con, str(value), str(prop)]) + '\n')
 
-def table_to_mut(table_file, ref_file, outfile):
+
+def table_to_mut(table_file, ref_file, outfile, stats=None):
     # Parse a table of mutations, and select only snvs.
     # Add end pos, sample name, alt_depth(1), depth (100), N (0), subtype column for snvs ("C>T" etc).
+    # Progress is reported through stats (a ReadStats), if given.
 
-    print('Start parsing {}'.format(table_file))
+    stats = ReadStats() if stats is None else stats
+    stats.begin('reference')
 
     # open outfile
     fo = open(outfile, "w")
@@ -413,18 +1553,18 @@ def table_to_mut(table_file, ref_file, outfile):
     fo.write('\t'.join(header)+'\n')
 
     
-    ref_dict = fasta_to_dict(ref_file)
-    # extracting key names and start coordinates of probes
-    dictkeys = list(ref_dict.keys())
-    print(dictkeys)
+    ref_dict = open_reference(ref_file)
+    stats.begin('table_to_mut')
 
     kmer_len = 3 # trincleotides
 
     #test = 100
     ind = 0
     
-    with open(table_file, 'r') as handle:
+    with open_mut_file(table_file) as handle:
         for line in handle:
+            stats.read([line])
+
             # Strip newline characters and split on tabs
             line = line.strip().split('\t')
             # expected entries: chr, pos, ref, alt, filter
@@ -436,9 +1576,8 @@ def table_to_mut(table_file, ref_file, outfile):
             pos = int(line[1])
 
             # check for non-snvs
-            if len(ref)>1:
-                continue
-            if len(alt)>1:
+            if len(ref)>1 or len(alt)>1:
+                stats.skip('not_snv')
                 continue
 
             mut = ref+'>'+alt
@@ -457,13 +1596,14 @@ def table_to_mut(table_file, ref_file, outfile):
 ##                fo.close()
 ##                return
             ind+=1
+            stats.count('mutations')
 
-            if ind % 1000 == 0:
-                print('Processed {} mutations'.format(str(ind)))
+            if ind % stats.interval == 0:
+                stats.progress()
                 
 
     fo.close()
-    print('Parsing done!')
+    stats.end()
 
 
     #def table_to_mut (table_file, ref_file, outfile):
@@ -478,16 +1618,21 @@ def table_to_mut(table_file, ref_file, outfile):
 
 
     
-def check_mut_integrity(mut_file):
+def check_mut_integrity(mut_file, stats=None):
 
     # Parse a mut file and check that reference base is the same as the middle base of the trinucleotide context
     # Expect .mut file type columns: chr, start, end, sample, var_type, ref, alt, alt_depth, depth, N, subtype, context
+    # Returns a list of (chrom, position, ref, context) discrepancies. Progress is reported through stats, if given.
 
-    print('Start parsing {}'.format(mut_file))
+    stats = ReadStats() if stats is None else stats
+    stats.begin('check_mut_integrity')
+    discrepancies = []
 
     ind = 0
-    with open(mut_file, 'r') as handle:
+    with open_mut_file(mut_file) as handle:
         for line in handle:
+            stats.read([line])
+
             # Strip newline characters and split on tabs
             line = line.strip().split('\t')
             # expected entries: chr, start, end, sample, var_type, ref, alt, alt_depth, depth, N, subtype, context
@@ -498,13 +1643,185 @@ def check_mut_integrity(mut_file):
             context = line[11]
 
             if ref!=context[1]:
-                print ('Discrepancy found on {}, position {}. Ref:{} Context: {}'.format(line[0], line[1], ref, context))
+                discrepancies.append((line[0], line[1], ref, context))
+                stats.count('discrepancies')
 
             ind+=1
+            stats.count('mutations')
+
+            if ind % stats.interval==0:
+               stats.progress()
+
+    stats.end()
+    return discrepancies
+
+
+def _count_contig_kmers(store_file, chrom, k, block=1 << 24):
+    # Count the kmers of one contig of a packed reference as a 4**k array,
+    # skipping windows that contain an N. Works on blocks of the contig
+    # (overlapping by k-1 bases) to bound memory.
+
+    store = RefStore(store_file)
+    length = store.length(chrom)
+    counts = np.zeros(4 ** k, dtype=np.int64)
+
+    for start in range(0, max(length - k + 1, 0), block):
+        codes = store.codes(chrom, start, min(start + block + k - 1, length))
+        nwin = len(codes) - k + 1
+
+        # Windows without N: no N flag between window start and end
+        nflags = np.concatenate(([0], np.cumsum(codes == 4)))
+        valid = nflags[k:] == nflags[:nwin]
+
+        # Rolling base-4 encoding of each window
+        index = np.zeros(nwin, dtype=np.int64)
+        for j in range(k):
+            index = index * 4 + (codes[j:j + nwin] & 3)
+
+        counts += np.bincount(index[valid], minlength=4 ** k)
+
+    return counts
+
+
+def count_kmers(ref_file, k=3, workers=None, cache_dir=None):
+    """
+    Count all kmers of length k in a reference (forward strand of every
+    contig), skipping kmers that contain an N. This replaces the kmer count
+    files made with jellyfish or bbmap.
+
+    Contigs are counted in parallel in a process pool over the packed
+    reference (see open_reference). Results are cached as .npy files named
+    after a hash of the FASTA path, size and modification time (as
+    fasta_to_dict), so a reference is only counted once for each k and a
+    cache hit does not read the FASTA.
+
+    Parameters
+    ----------
+    ref_file : str
+        Reference FASTA.
+    k : int
+        Kmer length.
+    workers : int or None
+        Number of worker processes (default: number of CPUs); 1 counts in
+        this process.
+    cache_dir : str or None
+        Directory for cached counts (default: the directory of ref_file, or
+        the store directory, see set_store_dir).
+
+    Returns
+    -------
+    counts : OrderedDict
+        Count of every kmer (all 4**k, in lexicographic order).
+    """
+
+    stat = os.stat(ref_file)
+    key = (os.path.abspath(ref_file), stat.st_size, stat.st_mtime)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+
+    name = 'kmers-{}-k{}.npy'.format(digest, k)
+    if cache_dir is None:
+        cache_files = [os.path.join(os.path.dirname(os.path.abspath(path)), name)
+                       for path in _derived_candidates(ref_file, '')]
+    else:
+        cache_files = [os.path.join(cache_dir, name)]
+    found = [path for path in cache_files if os.path.exists(path)]
+
+    if found:
+        counts = np.load(found[0])
+    else:
+        store = open_reference(ref_file)
+        jobs = [(store.path, chrom, k) for chrom in store.keys()]
+        if workers == 1:
+            results = [_count_contig_kmers(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_count_contig_kmers, *zip(*jobs)))
+        counts = np.sum(results, axis=0) if results else np.zeros(4 ** k, dtype=np.int64)
+
+        with _atomic_file(cache_files[0]) as fo:
+            np.save(fo, counts)
+
+    kmers = (''.join(kmer) for kmer in product(dna_bases, repeat=k))
+    return OrderedDict(zip(kmers, counts.tolist()))
+
+
+batch_operations = ('spectrum', 'contexts', 'integrity')
+
+
+def _batch_job(operation, mut_file, ref_file, output, kwargs):
+    # Run one batch operation on one file. Returns a result dict rather than
+    # raising, so one bad file does not stop the batch.
+
+    start = time.perf_counter()
+    stats = ReadStats()
+    result, error = None, None
+    try:
+        if operation == 'spectrum':
+            result = mut_to_msp(mut_file, output, ref_file=ref_file, stats=stats, **kwargs)
+        elif operation == 'contexts':
+            result = extract_contexts(mut_file, ref_file, output, stats=stats, **kwargs)
+        else:
+            result = check_mut_integrity(mut_file, stats=stats, **kwargs)
+    except Exception as err:
+        error = '{}: {}'.format(type(err).__name__, err)
+
+    return {'file': mut_file, 'result': result, 'error': error,
+            'seconds': time.perf_counter() - start, 'stats': stats.summary()}
+
+
+def run_batch(mut_files, operation, ref_file=None, outputs=None, workers=None, **kwargs):
+    """
+    Run a MutLib operation on many mutation files across a process pool.
+
+    The reference is packed once (see open_reference) and every worker maps
+    the same store file, so the operating system shares its pages instead of
+    each worker holding a copy of the reference.
+
+    Parameters
+    ----------
+    mut_files : list of str
+        Input .mut / .mutpos files.
+    operation : 'spectrum', 'contexts' or 'integrity'
+        mut_to_msp, extract_contexts or check_mut_integrity.
+    ref_file : str or None
+        Reference FASTA (or packed store) shared by all files.
+    outputs : list or None
+        Per-file output: msp file path for 'spectrum', dict of mutation type
+        to path for 'contexts'. Not used for 'integrity'.
+    workers : int or None
+        Number of worker processes (default: number of CPUs). With 1, files
+        are processed serially in this process.
+    **kwargs
+        Passed to the operation for every file (ie. maxratio, window).
+
+    Returns
+    -------
+    results : list of dict
+        One dict per input file, in input order, with keys 'file', 'result',
+        'error' (None on success), 'seconds' and 'stats' (ReadStats summary).
+    """
+
+    if operation not in batch_operations:
+        raise ValueError('Operation must be one of {}'.format(', '.join(batch_operations)))
+    if outputs is None:
+        outputs = [None] * len(mut_files)
+    if len(outputs) != len(mut_files):
+        raise ValueError('Need one output per input file')
+    if operation == 'contexts' and None in outputs:
+        raise ValueError('Context extraction needs outputs for every file')
+
+    if ref_file is not None:
+        ref_file = open_reference(ref_file).path
+
+    jobs = [(operation, mut_file, ref_file, output, kwargs)
+            for mut_file, output in zip(mut_files, outputs)]
+
+    if workers == 1:
+        return [_batch_job(*job) for job in jobs]
 
-            if ind % 1000==0:
-               print('Processed {} mutations'.format(str(ind)))
-    print('Parsing done!')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_batch_job, *job) for job in jobs]
+        return [future.result() for future in futures]
 
 
 ############
@@ -512,10 +1829,34 @@ def check_mut_integrity(mut_file):
 ############
          
             
+def check_mutpos_formats():
+    """
+    Check that the same sites written in the Essigmann (A, C, G, T counts) and
+    Loeb (T, C, G, A counts) .mutpos layouts parse to the same counts.
+    Raises AssertionError otherwise.
+    """
+
+    sites = [('chr1', ref, pos, 500, counts) for pos, (ref, counts) in enumerate(
+        [('A', (480, 5, 10, 5)), ('C', (4, 470, 20, 6)), ('G', (7, 30, 460, 3)),
+         ('T', (2, 9, 1, 488))], 1)]
+    essigmann = ['\t'.join(map(str, (chrom, ref, pos, depth) + counts)) + '\n'
+                 for chrom, ref, pos, depth, counts in sites]
+    loeb = ['\t'.join(map(str, (chrom, ref, pos, depth, 0) +
+                          tuple(counts[dna_bases.index(b)] for b in loeb_bases))) + '\n'
+            for chrom, ref, pos, depth, counts in sites]
+
+    expected = np.array([counts for *_, counts in sites])
+    for fmt, lines in (('essigmann', essigmann), ('loeb', loeb)):
+        parsed = _parse_mutpos_chunk(lines, fmt)[4]
+        assert (parsed == expected).all(), '{} counts are not in A, C, G, T order'.format(fmt)
+
+
 def main():
 
     #test code
 
+    check_mutpos_formats()
+
 ##    ref_gpt = "Dev/EG10_rgc_Corrected.fasta"
 ##    ref_twnstr = "Dev/mm10_twst-probes50.fa"
 ##    
@@ -524,7 +1865,9 @@ def main():
 ##    out_path = "Output/"
 ##
 ##    extract_mut_contexts(mut_file, ref_twnstr, out_path+"8217_13base_G-A.txt", "G>A", 6) 
-    
+
+    return
+
 
 if __name__ == '__main__':
     main()
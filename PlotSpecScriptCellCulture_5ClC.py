@@ -11,7 +11,6 @@ import PlotSpec as ps
 import ClustPlot as cp
 import matplotlib as mpl
 mpl.use('Agg')
-import matplotlib.pyplot as plt
 
 print(ps.pu_muts)
 
@@ -139,12 +138,9 @@ def main():
 ##            plt.savefig(picspath+sam+'_bgsub_norm.png')
 
         #plotting composite figs
-        mpl.rc("savefig", dpi=600)
         ps.spec_figure(4, 1, val_list, xlabels=xlab_list, labels=ps.pu_muts,
-                       titles=datasamples, ylabel='Proportion of mutations', colorscheme='COSMIC3')
-
-        plt.savefig(picspath+'5ClC-specs_4x1.svg')
-        plt.savefig(picspath+'5ClC-specs_4x1.png')
+                       titles=datasamples, ylabel='Proportion of mutations', colorscheme='COSMIC3',
+                       outputs=[picspath+'5ClC-specs_4x1.svg', picspath+'5ClC-specs_4x1.png'], dpi=600)
     
     
 
@@ -179,8 +175,7 @@ def main():
             plotfile1 = picspath+'histplot'+str(st_col)+'.'+ext1
             plotfile2 = picspath+'histplot'+str(st_col)+'.'+ext2
 
-            cp.plot_uhc_heatmap(spec_list, datasamples, True, plotfile1, ext1, st_col)  
-            cp.plot_uhc_heatmap(spec_list, datasamples, True, plotfile2, ext2, st_col)  
+            cp.plot_uhc_heatmap(spec_list, datasamples, True, [plotfile1, plotfile2], [ext1, ext2], st_col)  
 
 
 
@@ -208,11 +203,9 @@ def main():
         val_list.append(vals)
 
         #plotting
-        mpl.rc("savefig", dpi=320)
         ps.spec_figure(1, 1, [vals], xlabels=[xlab], labels=ps.py_muts, errorbars=None,
-                       titles=['5ClC-gptDCS'], ylabel='Proportion of mutations')
-        plt.savefig(picspath+csvfile[:-4]+'.svg')
-        plt.savefig(picspath+csvfile[:-4]+'.png')
+                       titles=['5ClC-gptDCS'], ylabel='Proportion of mutations',
+                       outputs=[picspath+csvfile[:-4]+'.svg', picspath+csvfile[:-4]+'.png'], dpi=320)
 
 
     if prog==5:
@@ -234,12 +227,9 @@ def main():
             xlab_list.append(xlab)
 
         #plotting composite figs
-        mpl.rc("savefig", dpi=600)
         ps.spec_figure(5, 1, val_list, xlabels=xlab_list, labels=ps.pu_muts,
-                       titles=datasamples, ylabel='Proportion of mutations', colorscheme='COSMIC3')
-
-        plt.savefig(picspath+'5ClC-specs_5x1.svg')
-        plt.savefig(picspath+'5ClC-specs_5x1.png')
+                       titles=datasamples, ylabel='Proportion of mutations', colorscheme='COSMIC3',
+                       outputs=[picspath+'5ClC-specs_5x1.svg', picspath+'5ClC-specs_5x1.png'], dpi=600)
         
 
     if prog==6:
@@ -273,8 +263,7 @@ def main():
             plotfile1 = picspath+'histplot'+str(st_col)+'.'+ext1
             plotfile2 = picspath+'histplot'+str(st_col)+'.'+ext2
 
-            cp.plot_uhc_heatmap(spec_list, datasamples, True, plotfile1, ext1, st_col)  
-            cp.plot_uhc_heatmap(spec_list, datasamples, True, plotfile2, ext2, st_col)  
+            cp.plot_uhc_heatmap(spec_list, datasamples, True, [plotfile1, plotfile2], [ext1, ext2], st_col)  
 
         
 
@@ -300,10 +289,8 @@ def main():
 
             val_list=[vals1, vals2]
 
-            mpl.rc("savefig", dpi=320)
             ps.spec_figure(2, 1, val_list, xlabels=xlab_list, labels=ps.pu_muts,
-                            ylabel='Mutation counts')
-            plt.savefig(picspath+sam+'.png')
+                            ylabel='Mutation counts', outputs=picspath+sam+'.png', dpi=320)
     
     if prog==7:
         
@@ -334,12 +321,9 @@ def main():
             xlab_list.append(xlab)
         
         #plotting composite figs
-        mpl.rc("savefig", dpi=320)
         ps.spec_figure(5, 1, val_list, xlabels=xlab_list, labels=ps.pu_muts,
-                       titles=datasamples, ylabel='Proportion of mutations')
-
-        plt.savefig(picspath+'Alkyl-agents_5x1_order2.svg')
-        plt.savefig(picspath+'Alkyl-agents_5x1_order2.png')
+                       titles=datasamples, ylabel='Proportion of mutations',
+                       outputs=[picspath+'Alkyl-agents_5x1_order2.svg', picspath+'Alkyl-agents_5x1_order2.png'], dpi=320)
 
 
 
@@ -353,13 +337,18 @@ def main():
 	
 
 
-        for sam in datasamples:
-            spec = ps.read_csv_file(datafiledict[sam])
-            subspec = ps.subtract_background(spec, avgspec)
+        # subtract the average control from all samples at once
+        specs = ps.SpectrumMatrix.from_files([datafiledict[sam] for sam in datasamples], names=datasamples)
+        subspecs, alpha, negvalues = specs.subtract_background(ps.Spectrum.from_dict(avgspec), mode='direct')
+
+        for i, sam in enumerate(datasamples):
+            spec = specs[sam].to_dict()
+            subspec = subspecs[sam].to_dict()
 
             print('spec has {} muts'.format(sum(spec.values())))
             print('bgr has {} muts'.format(sum(avgspec.values())))
-            print('subspec has {} muts'.format(sum(subspec.values())))
+            print('subspec has {} muts ({} negative values)'.format(sum(subspec.values()),
+                                                                   negvalues[i]))
             
             ps.save_csv_file(filespath+sam+'3.csv', spec)
             ps.save_csv_file(filespath+sam+'3_bgsub.csv', subspec)
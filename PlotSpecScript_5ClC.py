@@ -10,9 +10,8 @@ import PlotSpec as ps
 import ClustPlot as cp
 import matplotlib as mpl
 mpl.use('Agg')
-import matplotlib.pyplot as plt
 
-import MutScript as ms
+import MutLib as ml
 import os as os
 
 print(ps.pu_muts)
@@ -37,8 +36,6 @@ def generate_spectra(group, name, title, kmerfile):
     picfilepath="Pics2/"
     ####
 
-    kmer = ps.import_kmer_counts(kmerfile)
-
     # Printing with purine labels
     pu_dict=ps.init_spec_dict('purine')
     xlab = list(zip(*pu_dict.keys()))[1]
@@ -49,12 +46,12 @@ def generate_spectra(group, name, title, kmerfile):
 
     print(group)
 
-    new = ps.combine_csv_files(group, op='avg')
-    ps.save_csv_file(datafilepath+name[:-5]+'.csv', new)
+    # Combined and normalized spectra are cached (see ps.set_spectrum_cache), so a
+    # re-run with the same inputs reads both from the cache
+    ps.combine_spec_files(group, op='avg', outfile=datafilepath+name[:-5]+'.csv')
 
-    #new2=new
-    new2 = ps.normalize_spec(new, kmer)
-    ps.save_csv_file(datafilepath+name[:-5]+'-norm.csv', new2)
+    new2 = ps.combine_spec_files(group, op='avg', contexts=kmerfile,
+                                 outfile=datafilepath+name[:-5]+'-norm.csv')
 
     vals =list(zip(*new2.values()))[0]
     stds =list(zip(*new2.values()))[1]
@@ -65,39 +62,34 @@ def generate_spectra(group, name, title, kmerfile):
     xlab_list.append(xlab)
 
     #plotting individual plots
-    mpl.rc("savefig", dpi=320)
     ps.spec_figure(1, 1, [vals], xlabels=[xlab], labels=ps.pu_muts, errorbars=[stds],
-                   titles=[title], ylabel='Proportion of mutations')
-    plt.savefig(picfilepath+name+'.svg')
-    plt.savefig(picfilepath+name+'.png')
+                   titles=[title], ylabel='Proportion of mutations',
+                   outputs=[picfilepath+name+'.svg', picfilepath+name+'.png'], dpi=320)
 
     return
 
 
-def plot_msp(mspfile, title, kmerfile):
+def plot_msp(mspfile, title, kmerfile, template=None):
 
     # Plot one single msp file
     # The name of the figure will be same as msp file, but with svg and png extension
     # Title is a string for the plot title
     # kmerfile - file with trinucl counts for normalization
+    # template - ps.SpecTemplate to reuse across files (made here if None)
 
 
     ###Data paths
     datafilepath="Datafiles/"
     picfilepath="Pics/"
 
-    kmer = ps.import_kmer_counts(kmerfile)
-
     # Printing with purine labels
     #pu_dict=ps.init_spec_dict('purine')
     py_dict=ps.init_spec_dict()
     xlab = list(zip(*py_dict.keys()))[1]
 
-    spec = ps.read_msp_file(datafilepath+mspfile)
-
-    #normalization
-    newspec = ps.normalize_spec(spec, kmer)
-    ps.save_csv_file(datafilepath+mspfile[:-5]+'-norm.csv', newspec)
+    #normalization (cached, see ps.set_spectrum_cache)
+    newspec = ps.normalize_spec_file(datafilepath+mspfile, kmerfile, fmt='msp',
+                                     outfile=datafilepath+mspfile[:-5]+'-norm.csv')
 
     val_list=[]
     #vals =list(zip(*newspec.values()))[0]
@@ -105,11 +97,11 @@ def plot_msp(mspfile, title, kmerfile):
     val_list.append(vals)
 
     #plotting
-    mpl.rc("savefig", dpi=320)
-    ps.spec_figure(1, 1, [vals], xlabels=[xlab], labels=ps.py_muts, errorbars=None,
-                   titles=[title], ylabel='Proportion of mutations')
-    plt.savefig(picfilepath+mspfile[:-5]+'.svg')
-    plt.savefig(picfilepath+mspfile[:-5]+'.png')
+    if template is None:
+        template = ps.SpecTemplate(1, 1, xlabels=[xlab], labels=ps.py_muts,
+                                   ylabel='Proportion of mutations')
+    template.update([vals], errorbars=None, titles=[title])
+    template.save([picfilepath+mspfile[:-5]+'.svg', picfilepath+mspfile[:-5]+'.png'], dpi=320)
 
     return
     
@@ -125,6 +117,9 @@ def main():
     #kmerfile = 'bbmap.count.EG10c.txt'
     kmerfile = 'twnstr-mouse-contexts.txt'
 
+    # Cache of normalized/combined spectra, reused across runs
+    ps.set_spectrum_cache('SpecCache/')
+
     plotspectra=True
 
     hist= False
@@ -135,8 +130,6 @@ def main():
 
     cossimcosmic = False
 
-    strbias = False
-
     
     if plotspectra:
 
@@ -145,8 +138,13 @@ def main():
 
         mspfiles2=[file+ext for file in mspfiles]
 
+        # Same figure layout for all files, built once
+        py_dict=ps.init_spec_dict()
+        template = ps.SpecTemplate(1, 1, xlabels=[list(zip(*py_dict.keys()))[1]], labels=ps.py_muts,
+                                   ylabel='Proportion of mutations')
+
         for file, title in zip(mspfiles2, mspfiles):
-             plot_msp(file, title, kmerfile)
+             plot_msp(file, title, kmerfile, template)
 
         print ('done!')
              
@@ -181,8 +179,7 @@ def main():
             plotfile1 = picspath2+'histplot'+str(st_col)+'.'+ext1
             plotfile2 = picspath2+'histplot'+str(st_col)+'.'+ext2
 
-            cp.plot_uhc_heatmap(spec_list, datasamples, True, plotfile1, ext1, st_col)  
-            cp.plot_uhc_heatmap(spec_list, datasamples, True, plotfile2, ext2, st_col)  
+            cp.plot_uhc_heatmap(spec_list, datasamples, True, [plotfile1, plotfile2], [ext1, ext2], st_col)  
 
 
     if cossim:
@@ -232,8 +229,7 @@ def main():
         plotfile1 = picspath2+'ctrl-histplot'+str(2.3)+'.'+ext1
         plotfile2 = picspath2+'ctrl-histplot'+str(2.3)+'.'+ext2
 
-        cp.plot_uhc_heatmap(spec_list, datasamples, True, plotfile1, ext1, 2.3)  
-        cp.plot_uhc_heatmap(spec_list, datasamples, True, plotfile2, ext2, 2.3)  
+        cp.plot_uhc_heatmap(spec_list, datasamples, True, [plotfile1, plotfile2], [ext1, ext2], 2.3)  
 
 
     if generatemsp:
@@ -249,7 +245,7 @@ def main():
 
         for mutfile, outfile in zip(mutfiles2, outfiles):
 
-            ms.mut_to_msp(mutfile, outfile, maxratio=0.1, mindepth=1000)
+            ml.mut_to_msp(mutfile, outfile, maxratio=0.1, mindepth=1000)
 
 
         print ('done!')
@@ -293,25 +289,6 @@ def main():
 
 
 
-    if strbias:
-
-        # Strand bias calculation
-
-        mutfile='DataFIles/5ClC.mut'
-
-        num = list(range(1,20))
-        chrlist = ['chr'+str(r) for r in num]
-
-        print('chromosome', 'total', 'type', 'strand+', 'strand-', 'bias', sep='\t')
-
-        for c in chrlist:
-            ms.mut_count(mutfile, verbose=False, selection=[c])
-
-
-
-        return
-        
-
 if __name__=="__main__":
     main()
 
@@ -46,8 +46,7 @@ if process_mut:
 
         print('Proceesing file '+mut_file)
 
-        ml.extract_mut_contexts(mut_file, ref_twnstr, CT_file, CTmut, interval) 
-        ml.extract_mut_contexts(mut_file, ref_twnstr, TC_file, TCmut, interval)
+        ml.extract_contexts(mut_file, ref_twnstr, {CTmut: CT_file, TCmut: TC_file}, interval, file_type='mut')
 
 
 if process_mutpos:
@@ -60,7 +59,6 @@ if process_mutpos:
 
         print('Proceesing file '+mutpos_file)
 
-        ml.extract_mutpos_contexts(mutpos_file, ref_gpt, CT_file, CTmut, interval) 
-        ml.extract_mutpos_contexts(mutpos_file, ref_gpt, TC_file, TCmut, interval)
+        ml.extract_contexts(mutpos_file, ref_gpt, {CTmut: CT_file, TCmut: TC_file}, interval, file_type='mutpos')
 
 